@@ -7,15 +7,23 @@ Inspect directory and organize photos and videos
 
 import sys
 import argparse
+import asyncio
 import os
-import time
+import json
+import logging
 import shutil
+import sqlite3
+import math
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from operator import attrgetter
+import aiohttp
+import exifread
+import numpy as np
 from tqdm import tqdm
-from PIL import Image
-from PIL import ExifTags
+from tqdm.asyncio import tqdm_asyncio
 from datetime import datetime
-from os.path import isfile, join
-from geopy.geocoders import Nominatim
+from os.path import join
 
 
 class CustomFormatter(argparse.RawDescriptionHelpFormatter,
@@ -23,13 +31,75 @@ class CustomFormatter(argparse.RawDescriptionHelpFormatter,
     pass
 
 
+DEFAULT_CACHE_FILE = "~/.cache/photos-organize/geocode.sqlite"
+
+NOMINATIM_REVERSE_URL = "https://nominatim.openstreetmap.org/reverse"
+GEOCODE_TIMEOUT = 15
+GEOCODE_RETRIES = 3
+GEOCODE_BACKOFF = 1
+GEOCODE_CONCURRENCY = 1
+
+MOVE_WORKERS = 8
+
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+TIFF_SIGNATURES = (b"II*\x00", b"MM\x00*")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Same ISO base media brands exifread can parse
+HEIC_BRANDS = (b"ftypheic", b"ftypavif", b"ftypmif1")
+
+# exifread warns on every file without exif, e.g. each PNG screenshot
+logging.getLogger("exifread").setLevel(logging.ERROR)
+
 cache_loc = {}
+cache_db = None
+
+EXIF_DATE_TAGS = {
+    "EXIF DateTimeOriginal": "DateTimeOriginal",
+    "Image DateTime": "DateTime",
+}
+GPS_TAGS = {
+    f"GPS {name}": name
+    for name in ["GPSLatitude", "GPSLatitudeRef", "GPSLongitude", "GPSLongitudeRef"]
+}
+GPS_DMS_TAGS = ["GPSLatitude", "GPSLongitude"]
+GPS_REF_TAGS = ["GPSLatitudeRef", "GPSLongitudeRef"]
+DMS_WEIGHTS = np.array([1.0, 1 / 60.0, 1 / 3600.0])
+
+LOCATION_TRANS = str.maketrans({"/": "-", ".": "-", ":": "-"})
+
+
+class GeoLocation:
+    def __init__(self, raw):
+        self.raw = raw
+        self.address = raw.get("display_name")
+
+
+class TokenBucket:
+    """Spread acquisitions evenly at the given rate per second, no limit if rate is 0."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.interval:
+            return
+
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if wait > 0:
+            await asyncio.sleep(wait)
 
 
 class FileInfo:
-    def __init__(self, full_path):
+    def __init__(self, full_path, mtime=None, name=None):
         self.full_path = full_path
-        self.name = os.path.basename(full_path)
+        self.name = name if name else os.path.basename(full_path)
+        self.mtime = mtime
 
         self.errors = []
 
@@ -48,42 +118,40 @@ class FileInfo:
             self.errors.append(err)
         self.file_mod_date = rez
 
-        if self.exif:
-            rez, err = extract_location_from_exif(self.exif)
-            if err:
-                self.errors.append(err)
-            self.location = rez
-        else:
-            self.location = None
+        self.mod_date = self.exif_mod_date if self.exif_mod_date else self.file_mod_date
+        self.formatted_mod_date = self.mod_date.date().isoformat() if self.mod_date else "None"
+
+        self.coords = None
+        self.location = None
 
     def has_errors(self):
         return len(self.errors) > 0
 
     def get_mod_date(self):
-        return self.exif_mod_date if self.exif_mod_date else self.file_mod_date
+        return self.mod_date
 
     def format_mod_date(self):
-        return self.get_mod_date().strftime("%Y-%m-%d") if self.get_mod_date() else "None"
+        return self.formatted_mod_date
 
     def is_processable(self):
         return self.get_mod_date() is not None
 
     def extract_exif(self):
-        if self.full_path.lower().endswith(('.jpg', '.jpeg')):
-            try:
-                img = Image.open(self.full_path)
-            except Exception as err:
-                return None, err
-            else:
-                return {
-                    ExifTags.TAGS[k]: v
-                    for k, v in img._getexif().items()
-                    if k in ExifTags.TAGS
-                }, None
-        else:
-            return None, None
+        try:
+            with open(self.full_path, 'rb') as fp:
+                if not has_exif_signature(fp.read(12)):
+                    return None, None
+                # Stop the EXIF sub IFD right after DateTimeOriginal, GPS and DateTime live in IFD0
+                tags = exifread.process_file(fp, details=False, stop_tag="DateTimeOriginal",
+                                             extract_thumbnail=False)
+            return convert_exif_tags(tags), None
+        except Exception as err:
+            return None, err
 
     def extract_file_datetime(self):
+        if self.mtime is not None:
+            return datetime.fromtimestamp(self.mtime), None
+
         try:
             stat = os.stat(self.full_path)
         except Exception as err:
@@ -133,7 +201,7 @@ class FileInfo:
                         city_str = ''
                     place_str = place if place else ''
 
-                    loc = f"{city_str}{place_str}".replace("/", "-").replace(".", "-").replace(":", "-")
+                    loc = f"{city_str}{place_str}".translate(LOCATION_TRANS)
                     return loc
             else:
                 return "Unknown"
@@ -163,15 +231,47 @@ def parse_args(args):
                    action="store_true",
                    help="Perform dry run without changes")
 
+    g.add_argument("--cache-file",
+                   action="store",
+                   default=DEFAULT_CACHE_FILE,
+                   help="File to persist geo locations cache between runs")
+
+    g.add_argument("--geocode-url",
+                   action="store",
+                   default=NOMINATIM_REVERSE_URL,
+                   help="Nominatim reverse geocoding endpoint, e.g. of a local instance")
+
+    g.add_argument("--geocode-rate",
+                   action="store",
+                   type=float,
+                   default=1.0,
+                   help="Max geocoding requests per second, 0 for no limit")
+
+    g.add_argument("--geocode-concurrency",
+                   action="store",
+                   type=int,
+                   default=GEOCODE_CONCURRENCY,
+                   help="Max geocoding requests in flight, raise only for a local Nominatim")
+
     return parser.parse_args(args)
 
 
 def retrieve_file_info(directory, options):
-    only_files = [f for f in os.listdir(directory) if isfile(join(directory, f))]
-    files = []
-    for file in tqdm(only_files):
-        file_info = FileInfo(join(directory, file))
-        files.append(file_info)
+    with os.scandir(directory) as it:
+        entries = [e for e in it if e.is_file()]
+    only_files = [e.path for e in entries]
+    names = [e.name for e in entries]
+    mtimes = [get_entry_mtime(e) for e in entries]
+
+    # Workers only read exif and file stats, geocoding stays in main process to share cache_loc
+    workers = os.cpu_count() or 1
+    chunksize = max(1, len(only_files) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        files = list(tqdm(executor.map(FileInfo, only_files, mtimes, names, chunksize=chunksize),
+                          total=len(only_files)))
+
+    resolve_coordinates(files)
+    resolve_locations(files, options)
 
     print(f"Processed files: {len(files)}")
     with_errors = list(filter(lambda f: f.has_errors(), files))
@@ -188,37 +288,124 @@ def retrieve_file_info(directory, options):
         move_files(fixed, directory, options)
 
 
+def get_entry_mtime(entry):
+    try:
+        return entry.stat().st_mtime
+    except OSError:
+        return None
+
+
+def resolve_coordinates(files):
+    tagged = []
+    dms = []
+    signs = []
+    for f in files:
+        geotags = get_geotagging(f.exif)
+        if geotags and all(key in geotags for key in GPS_TAGS.values()):
+            try:
+                dms.append(get_dms_row(geotags))
+            except Exception as err:
+                f.errors.append(err)
+            else:
+                tagged.append(f)
+                signs.append([-1.0 if geotags[ref] in ['S', 'W'] else 1.0 for ref in GPS_REF_TAGS])
+
+    if not tagged:
+        return
+
+    # Convert all files at once: (N, lat/lon, deg/min/sec, num/den) -> (N, lat/lon)
+    dms = np.array(dms, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coords = np.round(np.array(signs) * ((dms[..., 0] / dms[..., 1]) @ DMS_WEIGHTS), 5)
+
+    for f, (lat, lon) in zip(tagged, coords.tolist()):
+        if not (math.isfinite(lat) and math.isfinite(lon)):
+            f.errors.append(ValueError(f"Invalid GPS coordinates {get_geotagging(f.exif)}"))
+        elif lat and lon:
+            f.coords = {"lat": lat, "lon": lon}
+
+
+def get_dms_row(geotags):
+    row = []
+    for key in GPS_DMS_TAGS:
+        dms = [(float(num), float(den)) for num, den in geotags[key]]
+        if len(dms) != 3:
+            raise ValueError(f"Unexpected {key} value {geotags[key]}")
+        row.append(dms)
+    return row
+
+
+def resolve_locations(files, options):
+    unique = {}
+    for f in files:
+        if f.coords:
+            unique.setdefault(create_cache_loc_key(f.coords), f.coords)
+
+    # One geocode request per cache key instead of one per file
+    missing = [coords for coords in unique.values() if not find_cache_location(coords)]
+    results = find_geo_locations(missing, options.geocode_url, options.geocode_rate,
+                                 options.geocode_concurrency)
+
+    errors = {}
+    for coords, (location, err) in zip(missing, results):
+        if err:
+            errors[create_cache_loc_key(coords)] = err
+        else:
+            save_cache_location(coords, location)
+
+    for f in files:
+        if f.coords:
+            key = create_cache_loc_key(f.coords)
+            if key in errors:
+                f.errors.append(errors[key])
+            else:
+                f.location = find_cache_location(f.coords)
+
+
 def fix_locations(processable):
-    processable.sort(key=lambda f: f.get_mod_date())
+    processable.sort(key=attrgetter("mod_date"))
+    next_idx = build_next_with_loc_index(processable)
 
     for i, f in enumerate(processable):
         if not f.location:
             try:
-                find_location_around(processable, i)
+                find_location_around(processable, i, next_idx)
             except Exception as err:
                 print(f"Error on {i}: {err}")
 
     return processable
 
 
-def find_location_around(files, i):
+def build_next_with_loc_index(files):
+    # next_idx[i] is the first index j >= i of a file with location. Locations are only filled
+    # in up to the current file, so the index stays valid during the whole fix_locations pass
+    next_idx = [None] * len(files)
+    last = None
+    for i in range(len(files) - 1, -1, -1):
+        if files[i].location:
+            last = i
+        next_idx[i] = last
+    return next_idx
+
+
+def find_location_around(files, i, next_idx):
     if i > 0:
-        before_datetime = files[i-1].get_mod_date()
+        before_datetime = files[i-1].mod_date
         loc = files[i-1].location
-        diff = files[i].get_mod_date() - before_datetime
+        diff = files[i].mod_date - before_datetime
         check_and_update_location(diff, files, i, loc)
 
     if not files[i].location and i < len(files)-1:
-        after_datetime, loc = find_next_with_loc(files, i+1)
+        after_datetime, loc = find_next_with_loc(files, next_idx, i+1)
         if after_datetime:
-            diff = after_datetime - files[i].get_mod_date()
+            diff = after_datetime - files[i].mod_date
             check_and_update_location(diff, files, i, loc)
 
 
-def find_next_with_loc(files, start):
-    for x in range(start, len(files)):
-        if files[x].location:
-            return files[x].get_mod_date(), files[x].location
+def find_next_with_loc(files, next_idx, start):
+    x = next_idx[start]
+    if x is not None:
+        return files[x].mod_date, files[x].location
     return None, None
 
 
@@ -229,36 +416,43 @@ def check_and_update_location(diff, files, i, loc):
 
 
 def move_files(files, directory, options):
-    groups = {}
+    groups = defaultdict(lambda: defaultdict(list))
     for f in files:
-        f_date = f.format_mod_date()
-        if f_date not in groups:
-            groups[f_date] = {}
-
-        f_loc = f.get_location_place()
-        if f_loc not in groups[f_date]:
-            groups[f_date][f_loc] = []
-
-        groups[f_date][f_loc].append(f)
+        groups[f.format_mod_date()][f.get_location_place()].append(f)
 
     if options.dry_run:
         print("Dry run, so no movements are done")
+        return
 
-    for key_date in tqdm(groups):
+    # Create all sub dirs upfront so move workers never race on mkdir
+    for key_date in groups:
         sub_dir_date = join(directory, key_date)
-
-        if not options.dry_run and not os.path.exists(sub_dir_date):
+        if not os.path.exists(sub_dir_date):
             os.mkdir(sub_dir_date)
 
-        for key_loc in tqdm(groups[key_date], leave=False):
+        for key_loc in groups[key_date]:
             sub_dir_loc = join(sub_dir_date, key_loc)
-
-            if not options.dry_run and not os.path.exists(sub_dir_loc):
+            if not os.path.exists(sub_dir_loc):
                 os.mkdir(sub_dir_loc)
 
-            for f in tqdm(groups[key_date][key_loc], leave=False):
-                if not options.dry_run:
-                    shutil.move(f.full_path, join(sub_dir_loc, f.name))
+    dir_dev = os.stat(directory).st_dev
+
+    total_files = sum(len(loc_files) for loc_groups in groups.values() for loc_files in loc_groups.values())
+
+    with ThreadPoolExecutor(max_workers=MOVE_WORKERS) as executor, \
+            tqdm(total=total_files, mininterval=0.5) as pbar:
+        for key_date in groups:
+            sub_dir_date = join(directory, key_date)
+
+            for key_loc in groups[key_date]:
+                sub_dir_loc = join(sub_dir_date, key_loc)
+                loc_files = groups[key_date][key_loc]
+
+                # Rename is a metadata only operation when files stay on the same file system
+                move = os.replace if os.stat(sub_dir_loc).st_dev == dir_dev else shutil.move
+
+                for _ in executor.map(lambda f: move(f.full_path, join(sub_dir_loc, f.name)), loc_files):
+                    pbar.update(1)
 
 
 def confirm():
@@ -273,14 +467,35 @@ def confirm():
     return answer == "y"
 
 
+def open_cache_db(path):
+    global cache_db
+    cache_dir = os.path.dirname(path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    cache_db = sqlite3.connect(path)
+    cache_db.execute("CREATE TABLE IF NOT EXISTS geo(key TEXT PRIMARY KEY, addr JSON)")
+
+
 def save_cache_location(coords, location):
     key = create_cache_loc_key(coords)
     cache_loc[key] = location
+    if cache_db and location:
+        cache_db.execute("INSERT OR REPLACE INTO geo(key, addr) VALUES (?, ?)", (key, json.dumps(location.raw)))
+        cache_db.commit()
 
 
 def find_cache_location(coords):
     key = create_cache_loc_key(coords)
-    return cache_loc[key] if key in cache_loc else None
+    if key in cache_loc:
+        return cache_loc[key]
+
+    if cache_db:
+        row = cache_db.execute("SELECT addr FROM geo WHERE key = ?", (key,)).fetchone()
+        if row:
+            location = GeoLocation(json.loads(row[0]))
+            cache_loc[key] = location
+            return location
+    return None
 
 
 def create_cache_loc_key(coords):
@@ -290,32 +505,47 @@ def create_cache_loc_key(coords):
     return key
 
 
-def extract_location_from_exif(exif):
-    geotags = get_geotagging(exif)
-    if geotags:
-        try:
-            coords = get_coordinates(geotags)
-            if coords["lat"] and coords["lon"]:
-                cached_location = find_cache_location(coords)
-                if cached_location:
-                    return cached_location, None
-                else:
-                    location = find_geo_location(coords)
-                    save_cache_location(coords, location)
-                    return location, None
+async def reverse_location(session, semaphore, bucket, url, coords):
+    params = {"format": "jsonv2", "lat": str(coords["lat"]), "lon": str(coords["lon"])}
+    async with semaphore:
+        for attempt in range(GEOCODE_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                async with session.get(url, params=params) as response:
+                    response.raise_for_status()
+                    raw = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as err:
+                # ValueError covers a body that is not JSON, e.g. an HTML block page
+                if attempt == GEOCODE_RETRIES or not is_retryable_error(err):
+                    return None, err
             else:
-                return None, None
-        except Exception as err:
-            return None, err
-    else:
-        return None, None
+                if not isinstance(raw, dict):
+                    return None, ValueError(f"Unexpected geocoder response {raw!r}")
+                return (GeoLocation(raw) if "error" not in raw else None), None
+
+            # Back off so an overloaded server is not hit again right away
+            await asyncio.sleep(GEOCODE_BACKOFF * 2 ** attempt)
 
 
-def find_geo_location(coords):
-    geolocator = Nominatim(user_agent="PhotoGeo")
-    location = geolocator.reverse(f"{coords['lat']}, {coords['lon']}")
-    time.sleep(1)
-    return location
+def is_retryable_error(err):
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status == 429 or not 400 <= err.status < 500
+    return True
+
+
+async def reverse_locations(coords_list, url, rate, concurrency):
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    bucket = TokenBucket(rate)
+    timeout = aiohttp.ClientTimeout(total=GEOCODE_TIMEOUT)
+    async with aiohttp.ClientSession(headers={"User-Agent": "PhotoGeo"}, timeout=timeout) as session:
+        return await tqdm_asyncio.gather(
+            *[reverse_location(session, semaphore, bucket, url, coords) for coords in coords_list])
+
+
+def find_geo_locations(coords_list, url, rate, concurrency=GEOCODE_CONCURRENCY):
+    if not coords_list:
+        return []
+    return asyncio.run(reverse_locations(coords_list, url, rate, concurrency))
 
 
 def find_place(addr, place_names):
@@ -325,40 +555,39 @@ def find_place(addr, place_names):
     return None
 
 
-def get_decimal_from_dms(dms, ref):
-    degrees = dms[0][0] / dms[0][1]
-    minutes = dms[1][0] / dms[1][1] / 60.0
-    seconds = dms[2][0] / dms[2][1] / 3600.0
+def has_exif_signature(sig):
+    # JPEG, TIFF based RAW, PNG and HEIC/AVIF files can carry exif, anything else is skipped
+    return (sig[:3] == JPEG_SIGNATURE
+            or sig[:4] in TIFF_SIGNATURES
+            or sig[:8] == PNG_SIGNATURE
+            or sig[4:12] in HEIC_BRANDS)
 
-    if ref in ['S', 'W']:
-        degrees = -degrees
-        minutes = -minutes
-        seconds = -seconds
 
-    return round(degrees + minutes + seconds, 5)
+def get_geotagging(exif):
+    return exif.get('GPSInfo') if exif else None
 
 
-def get_coordinates(geotags):
-    if 'GPSLatitude' in geotags and 'GPSLatitudeRef' in geotags:
-        lat = get_decimal_from_dms(geotags['GPSLatitude'], geotags['GPSLatitudeRef'])
-    else:
-        lat = None
+def convert_exif_tags(tags):
+    exif = {name: tags[key].printable for key, name in EXIF_DATE_TAGS.items() if key in tags}
 
-    if 'GPSLongitude' in geotags and 'GPSLongitudeRef' in geotags:
-        lon = get_decimal_from_dms(geotags['GPSLongitude'], geotags['GPSLongitudeRef'])
-    else:
-        lon = None
-    return {"lat": lat, "lon": lon}
+    gps = {name: convert_gps_value(tags[key].values) for key, name in GPS_TAGS.items() if key in tags}
+    if gps:
+        exif["GPSInfo"] = gps
 
+    return exif
+
+
+def convert_gps_value(values):
+    if isinstance(values, str):
+        return values
+    return tuple(convert_gps_number(v) for v in values)
 
-def get_geotagging(exif):
-    if exif and 'GPSInfo' in exif:
-        geotagging = {}
-        for (key, val) in ExifTags.GPSTAGS.items():
-            if key in exif['GPSInfo']:
-                geotagging[val] = exif['GPSInfo'][key]
-        return geotagging
-    return None
+
+def convert_gps_number(value):
+    # GPS values are usually RATIONAL, but some writers store them as SHORT or LONG
+    if isinstance(value, (int, float)):
+        return value, 1
+    return value.num, value.den
 
 
 def main(argv):
@@ -368,6 +597,8 @@ def main(argv):
             print("DRY RUN")
             print("-------")
 
+        open_cache_db(os.path.expanduser(options.cache_file))
+
         directory = os.path.expanduser(options.dir)
         print(f"Processing {directory}")
         retrieve_file_info(directory, options)